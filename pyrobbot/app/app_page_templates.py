@@ -3,7 +3,6 @@
 import base64
 import contextlib
 import datetime
-import queue
 import time
 import uuid
 from abc import ABC, abstractmethod
@@ -15,16 +14,22 @@ from audio_recorder_streamlit import audio_recorder
 from loguru import logger
 from pydub import AudioSegment
 from pydub.exceptions import CouldntDecodeError
+from pydub.utils import mediainfo
 from streamlit_mic_recorder import mic_recorder
 
 from pyrobbot.chat_configs import VoiceChatConfigs
+from pyrobbot.tokens import truncate_to_last_n_tokens
 
 from .app_utils import (
     AsyncReplier,
     WebAppChat,
+    encode_audio_segment,
     filter_page_info_from_queue,
     get_avatar_images,
+    get_usage_balance_dataframe,
+    load_audio_file,
     load_chime,
+    load_chime_mp3_base64,
 )
 
 if TYPE_CHECKING:
@@ -33,6 +38,23 @@ if TYPE_CHECKING:
 # Sentinel object for when a chat is recovered from cache
 _RecoveredChat = object()
 
+_HTML_AUDIO_PLAYER_TEMPLATE = """
+                <audio controls {autoplay} {hidden} preload="metadata">
+                <source src="data:{mime_type};base64,{audio_base64}#" type="{mime_type}">
+                </audio>
+                """
+
+_TRIMMED_PAGE_PADDING_CSS = """
+                <style>
+                    .block-container {
+                        padding-top: 0rem;
+                        padding-bottom: 0rem;
+                        padding-left: 5rem;
+                        padding-right: 5rem;
+                    }
+                </style>
+                """
+
 
 class AppPage(ABC):
     """Abstract base class for a page within a streamlit application."""
@@ -98,18 +120,18 @@ class AppPage(ABC):
         """Create the page."""
 
     def continuous_mic_recorder(self):
-        """Record audio from the microphone in a continuous loop."""
+        """Record audio from the microphone in a continuous loop. None if no audio."""
         audio_bytes = audio_recorder(
             text="", icon_size="2x", energy_threshold=-1, key=f"AR_{self.page_id}"
         )
 
         if audio_bytes is None:
-            return AudioSegment.silent(duration=0)
+            return None
 
         return AudioSegment(data=audio_bytes)
 
     def manual_switch_mic_recorder(self):
-        """Record audio from the microphone."""
+        """Record audio from the microphone. Return None if nothing was recorded."""
         red_square = "\U0001F7E5"
         microphone = "\U0001F3A4"
         play_button = "\U000025B6"
@@ -123,7 +145,7 @@ class AppPage(ABC):
         )
 
         if recording is None:
-            return AudioSegment.silent(duration=0)
+            return None
 
         return AudioSegment(
             data=recording["bytes"],
@@ -148,25 +170,64 @@ class AppPage(ABC):
             logger.debug("No audio to play. Not rendering audio player.")
             return
 
-        if isinstance(audio, (str, Path)):
-            audio = AudioSegment.from_file(audio, format="mp3")
-        elif not isinstance(audio, AudioSegment):
+        if not isinstance(audio, (AudioSegment, str, Path)):
             raise TypeError(f"Invalid type for audio: {type(audio)}")
 
-        autoplay = "autoplay" if autoplay else ""
-        hidden = "hidden" if hidden else ""
+        if hidden and not autoplay:
+            logger.debug("Hidden audio player without autoplay. Nothing to render.")
+            return
 
-        data = audio.export(format="mp3").read()
-        b64 = base64.b64encode(data).decode()
-        md = f"""
-                <audio controls {autoplay} {hidden} preload="metadata">
-                <source src="data:audio/mpeg;base64,{b64}#" type="audio/mpeg">
-                </audio>
-                """
+        parent_element = parent_element or st
+        if not autoplay and not hidden:
+            # Let streamlit serve the audio as a media file. This avoids inflating the
+            # page with a base64-encoded copy of the audio and, for files, re-encoding.
+            if isinstance(audio, AudioSegment):
+                audio, mime_type = encode_audio_segment(audio)
+            else:
+                # History replays happen on every rerun. Don't read the files each time.
+                audio, mime_type = load_audio_file(str(audio)), "audio/mpeg"
+            parent_element.audio(audio, format=mime_type)
+            return
+
+        # Hidden and autoplaying players are not supported by st.audio
+        if isinstance(audio, (str, Path)):
+            # The file is already mp3: embed its bytes instead of decoding and
+            # re-encoding it. Only probe its duration if that's needed.
+            audio_data, mime_type = load_audio_file(str(audio)), "audio/mpeg"
+            duration_seconds = float(mediainfo(audio)["duration"]) if autoplay else 0
+        else:
+            audio_data, mime_type = encode_audio_segment(audio)
+            duration_seconds = audio.duration_seconds
+
+        self._render_html_audio_player(
+            audio_base64=base64.b64encode(audio_data).decode(),
+            duration_seconds=duration_seconds,
+            mime_type=mime_type,
+            parent_element=parent_element,
+            autoplay=autoplay,
+            hidden=hidden,
+        )
+
+    def _render_html_audio_player(  # noqa: PLR0913
+        self,
+        audio_base64: str,
+        duration_seconds: float,
+        mime_type: str = "audio/mpeg",
+        parent_element=None,
+        autoplay: bool = True,
+        hidden: bool = False,
+    ):
+        """Render an html audio player for base64-encoded audio data."""
+        md = _HTML_AUDIO_PLAYER_TEMPLATE.format(
+            autoplay="autoplay" if autoplay else "",
+            hidden="hidden" if hidden else "",
+            mime_type=mime_type,
+            audio_base64=audio_base64,
+        )
         parent_element = parent_element or st
         parent_element.markdown(md, unsafe_allow_html=True)
         if autoplay:
-            time.sleep(audio.duration_seconds)
+            time.sleep(duration_seconds)
 
 
 class ChatBotPage(AppPage):
@@ -239,6 +300,7 @@ class ChatBotPage(AppPage):
         new_chat_obj.openai_client = self.parent.openai_client
         self.state["chat_obj"] = new_chat_obj
         self.state["chat_configs"] = new_chat_obj.configs
+        self.state.pop("chat_input_placeholder", None)
         new_chat_obj.save_cache()
 
     @property
@@ -271,8 +333,8 @@ class ChatBotPage(AppPage):
 
     def render_cost_estimate_page(self):
         """Render the estimated costs information in the chat."""
-        general_df = self.chat_obj.general_token_usage_db.get_usage_balance_dataframe()
-        chat_df = self.chat_obj.token_usage_db.get_usage_balance_dataframe()
+        general_df = get_usage_balance_dataframe(self.chat_obj.general_token_usage_db)
+        chat_df = get_usage_balance_dataframe(self.chat_obj.token_usage_db)
         dfs = {"All Recorded Chats": general_df, "Current Chat": chat_df}
 
         st.header(dfs["Current Chat"].attrs["description"], divider="rainbow")
@@ -290,9 +352,13 @@ class ChatBotPage(AppPage):
 
     def play_chime(self, chime_type: str = "success", parent_element=None):
         """Sound a chime to send notificatons to the user."""
-        chime = load_chime(chime_type)
-        self.render_custom_audio_player(
-            chime, hidden=True, autoplay=True, parent_element=parent_element
+        # Chimes are played often, so use their cached mp3 encoding
+        self._render_html_audio_player(
+            audio_base64=load_chime_mp3_base64(chime_type),
+            duration_seconds=load_chime(chime_type).duration_seconds,
+            parent_element=parent_element,
+            autoplay=True,
+            hidden=True,
         )
 
     def render_title(self):
@@ -304,21 +370,36 @@ class ChatBotPage(AppPage):
             with left:
                 self.status_msg_container = st.empty()
 
+    @property
+    def chat_input_placeholder(self):
+        """Return the placeholder text for the chat input widget."""
+        # Only changes with the chat object, so keep it instead of rebuilding each rerun
+        if "chat_input_placeholder" not in self.state:
+            chat_obj = self.chat_obj
+            self.state["chat_input_placeholder"] = (
+                f"Send a message to {chat_obj.assistant_name} ({chat_obj.model})"
+            )
+        return self.state["chat_input_placeholder"]
+
     @property
     def direct_text_prompt(self):
         """Render chat inut widgets and return the user's input."""
-        placeholder = (
-            f"Send a message to {self.chat_obj.assistant_name} ({self.chat_obj.model})"
-        )
         text_from_manual_audio_recorder = ""
         with st.container():
             left, right = st.columns([0.9, 0.1])
             with left:
-                text_from_chat_input_widget = st.chat_input(placeholder=placeholder)
+                text_from_chat_input_widget = st.chat_input(
+                    placeholder=self.chat_input_placeholder
+                )
             with right:
                 if not st.session_state.get("toggle_continuous_voice_input"):
                     audio = self.manual_switch_mic_recorder()
-                    text_from_manual_audio_recorder = self.chat_obj.stt(audio).text
+                    # Most reruns carry no new recording. Don't run STT on silence.
+                    if audio:
+                        with st.spinner():
+                            text_from_manual_audio_recorder = self.chat_obj.stt(
+                                audio
+                            ).text
 
         return text_from_chat_input_widget or text_from_manual_audio_recorder
 
@@ -339,22 +420,116 @@ class ChatBotPage(AppPage):
         with self.status_msg_container:
             self.play_chime(chime_type="warning")
             with st.spinner(f"{self.chat_obj.assistant_name} is listening..."):
-                while True:
-                    with self.parent.text_prompt_queue.mutex:
-                        this_page_prompt_queue = filter_page_info_from_queue(
-                            app_page=self, the_queue=self.parent.text_prompt_queue
+                text_prompt_queue = self.parent.text_prompt_queue
+                prompt = ""
+                # The queue's not_empty condition shares the queue's mutex. Waiting on it
+                # blocks until new prompts are queued, instead of polling the queue.
+                with text_prompt_queue.not_empty:
+                    seen_entry_ids = set()
+                    while not prompt:
+                        this_page_prompts = filter_page_info_from_queue(
+                            app_page=self, the_queue=text_prompt_queue
                         )
-                    with contextlib.suppress(queue.Empty):
-                        if prompt := this_page_prompt_queue.get_nowait()["text"]:
-                            this_page_prompt_queue.task_done()
-                            break
-                    logger.trace("Still waiting for user text prompt...")
-                    time.sleep(0.1)
+                        if this_page_prompts:
+                            prompt = this_page_prompts.popleft()["text"]
+                            continue
+
+                        # The queue is shared by all pages, and each new prompt only
+                        # wakes one waiting page. If the new prompts are for other
+                        # pages, pass the wakeup on, so that they don't miss it.
+                        entry_ids = {id(entry) for entry in text_prompt_queue.queue}
+                        if not entry_ids <= seen_entry_ids:
+                            text_prompt_queue.not_empty.notify()
+                        seen_entry_ids = entry_ids
+                        logger.trace("Still waiting for user text prompt...")
+                        text_prompt_queue.not_empty.wait(timeout=0.5)
 
         logger.debug("Done getting user input: {}", prompt)
         return prompt
 
-    def _render_chatbot_page(self):  # noqa: PLR0915
+    def _append_user_message(self, prompt: str):
+        """Display the user's prompt and add it to the chat history."""
+        time_now = datetime.datetime.now().replace(microsecond=0)
+        self.state.update({"chat_started": True})
+        with st.chat_message("user", avatar=self.avatars["user"]):
+            st.caption(time_now)
+            st.markdown(prompt)
+        self.chat_history.append(
+            {
+                "role": "user",
+                "name": self.chat_obj.username,
+                "content": prompt,
+                "timestamp": time_now,
+            }
+        )
+
+    def _stream_assistant_reply(self, prompt: str) -> AsyncReplier:
+        """Stream the reply to `prompt` and add it to the chat history.
+
+        Return the replier, whose threads may still be playing the reply's audio.
+        """
+        with st.chat_message("assistant", avatar=self.avatars["assistant"]):
+            # Process text and audio replies asynchronously
+            replier = AsyncReplier(self, prompt)
+            reply = replier.stream_text_and_audio_reply()
+            self.chat_history.append(
+                {
+                    "role": "assistant",
+                    "name": self.chat_obj.assistant_name,
+                    "content": reply["text"],
+                    "reply_audio_file_path": reply["audio"],
+                    "chat_model": self.chat_obj.model,
+                }
+            )
+        return replier
+
+    def _maybe_update_title(self):
+        """Reset the title according to the conversation's initial contents."""
+        min_history_len_for_summary = 3
+        max_summary_prompt_tokens = 1500
+        if (
+            "page_title" in self.state
+            or len(self.chat_history) <= min_history_len_for_summary
+        ):
+            return
+
+        logger.debug("Working out conversation topic...")
+        # This only runs once per page, so the transcript is built here. Bound its
+        # size, however long the conversation gets.
+        transcript = "".join(
+            _msg_as_transcript_line(message) for message in self.chat_history
+        )
+        prompt = (
+            "Summarize the following messages in max 4 words:\n\n"
+            + truncate_to_last_n_tokens(
+                transcript,
+                model=self.chat_obj.model,
+                n_tokens=max_summary_prompt_tokens,
+            )
+        )
+        title = "".join(
+            self.chat_obj.respond_system_prompt(prompt, use_context=False, max_tokens=16)
+        )
+        self.chat_obj.metadata["page_title"] = title
+        self.chat_obj.metadata["sidebar_title"] = title
+        self.chat_obj.save_cache()
+
+        self.title = title
+        self.sidebar_title = title
+        self.title_container.header(title, divider="rainbow")
+
+    def _clear_page_prompt_queues(self):
+        """Clear the prompt queues for this page, to remove old prompts."""
+        with self.parent.continuous_user_prompt_queue.mutex:
+            filter_page_info_from_queue(
+                app_page=self, the_queue=self.parent.continuous_user_prompt_queue
+            )
+        with self.parent.text_prompt_queue.mutex:
+            filter_page_info_from_queue(
+                app_page=self, the_queue=self.parent.text_prompt_queue
+            )
+
+    def _render_chatbot_page(self):
         """Render a chatbot page.
 
         Adapted from:
@@ -392,68 +567,12 @@ class ChatBotPage(AppPage):
 
         if prompt:
             with chat_msgs_container:
-                # Process user input
-                if prompt:
-                    time_now = datetime.datetime.now().replace(microsecond=0)
-                    self.state.update({"chat_started": True})
-                    # Display user message in chat message container
-                    with st.chat_message("user", avatar=self.avatars["user"]):
-                        st.caption(time_now)
-                        st.markdown(prompt)
-                    self.chat_history.append(
-                        {
-                            "role": "user",
-                            "name": self.chat_obj.username,
-                            "content": prompt,
-                            "timestamp": time_now,
-                        }
-                    )
-
-                    # Display (stream) assistant response in chat message container
-                    with st.chat_message("assistant", avatar=self.avatars["assistant"]):
-                        # Process text and audio replies asynchronously
-                        replier = AsyncReplier(self, prompt)
-                        reply = replier.stream_text_and_audio_reply()
-                        self.chat_history.append(
-                            {
-                                "role": "assistant",
-                                "name": self.chat_obj.assistant_name,
-                                "content": reply["text"],
-                                "reply_audio_file_path": reply["audio"],
-                                "chat_model": self.chat_obj.model,
-                            }
-                        )
-
-                    # Reset title according to conversation initial contents
-                    min_history_len_for_summary = 3
-                    if (
-                        "page_title" not in self.state
-                        and len(self.chat_history) > min_history_len_for_summary
-                    ):
-                        logger.debug("Working out conversation topic...")
-                        prompt = "Summarize the previous messages in max 4 words"
-                        title = "".join(self.chat_obj.respond_system_prompt(prompt))
-                        self.chat_obj.metadata["page_title"] = title
-                        self.chat_obj.metadata["sidebar_title"] = title
-                        self.chat_obj.save_cache()
-
-                        self.title = title
-                        self.sidebar_title = title
-                        self.title_container.header(title, divider="rainbow")
-
-                    # Clear the prompt queue for this page, to remove old prompts
-                    with self.parent.continuous_user_prompt_queue.mutex:
-                        filter_page_info_from_queue(
-                            app_page=self,
-                            the_queue=self.parent.continuous_user_prompt_queue,
-                        )
-                    with self.parent.text_prompt_queue.mutex:
-                        filter_page_info_from_queue(
-                            app_page=self, the_queue=self.parent.text_prompt_queue
-                        )
-
-                    replier.join()
-                    self.parent.reply_ongoing.clear()
+                self._append_user_message(prompt)
+                replier = self._stream_assistant_reply(prompt)
+                self._maybe_update_title()
+                self._clear_page_prompt_queues()
+                replier.join()
+                self.parent.reply_ongoing.clear()
 
         if continuous_stt_prompt and not self.parent.reply_ongoing.is_set():
             logger.opt(colors=True).debug(
@@ -463,23 +582,13 @@ class ChatBotPage(AppPage):
 
     def render(self):
         """Render the app's chatbot or costs page, depending on user choice."""
-
-        def _trim_page_padding():
-            md = """
-                <style>
-                    .block-container {
-                        padding-top: 0rem;
-                        padding-bottom: 0rem;
-                        padding-left: 5rem;
-                        padding-right: 5rem;
-                    }
-                </style>
-                """
-            st.markdown(md, unsafe_allow_html=True)
-
-        _trim_page_padding()
+        st.markdown(_TRIMMED_PAGE_PADDING_CSS, unsafe_allow_html=True)
         if st.session_state.get("toggle_show_costs"):
             self.render_cost_estimate_page()
         else:
             self._render_chatbot_page()
         logger.debug("Reached the end of the chatbot page.")
+
+
+def _msg_as_transcript_line(message: dict[str, str]):
+    return f"{message['role']}: {message['content']}\n"
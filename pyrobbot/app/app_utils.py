@@ -1,10 +1,15 @@
 """Utility functions and classes for the app."""
 
-import contextlib
+import base64
+import collections
 import datetime
+import io
 import os
 import queue
 import threading
+import time
+import wave
+from pathlib import Path
 from typing import TYPE_CHECKING
 
 import streamlit as st
@@ -16,6 +21,7 @@ from twilio.rest import Client as TwilioClient
 
 from pyrobbot import GeneralDefinitions
 from pyrobbot.chat import AssistantResponseChunk
+from pyrobbot.tokens import TokenUsageDatabase
 from pyrobbot.voice_chat import VoiceChat
 
 if TYPE_CHECKING:
@@ -31,21 +37,26 @@ class WebAppChat(VoiceChat):
         self.tts_conversion_watcher_thread.start()
         self.handle_update_audio_history_thread.start()
 
+    def _build_play_speech_thread(self):
+        # The app's pages play the speech themselves (see `AsyncReplier`)
+        return None
+
 
 class AsyncReplier:
     """Asynchronously reply to a prompt and stream the text & audio reply."""
 
+    # Minimum time (in seconds) between re-renderings of the streamed text reply
+    min_render_interval = 0.05
+
     def __init__(self, app_page: "AppPage", prompt: str):
         """Initialize a new instance of the AsyncReplier class."""
         self.app_page = app_page
         self.prompt = prompt
 
         self.chat_obj = app_page.chat_obj
-        self.question_answer_chunks_queue = queue.Queue()
 
         self.threads = [
-            threading.Thread(name="queue_text_chunks", target=self.queue_text_chunks),
-            threading.Thread(name="play_queued_audios", target=self.play_queued_audios),
+            threading.Thread(name="play_queued_audios", target=self.play_queued_audios)
         ]
 
         self.start()
@@ -63,15 +74,59 @@ class AsyncReplier:
             thread.join()
         logger.debug("All {} threads finished", type(self).__name__)
 
-    def queue_text_chunks(self):
-        """Get chunks of the text reply to the prompt and queue them for display."""
-        exchange_id = None
-        for chunk in self.chat_obj.answer_question(self.prompt):
-            self.question_answer_chunks_queue.put(chunk)
-            exchange_id = chunk.exchange_id
-        self.question_answer_chunks_queue.put(
-            AssistantResponseChunk(exchange_id=exchange_id, content=None)
-        )
+    def text_reply_batches(self, reply_chunks: list[AssistantResponseChunk]):
+        """Yield the text reply to the prompt, batched by `min_render_interval`.
+
+        Streamlit re-renders the whole reply for every piece of text it is given, so
+        the chunks are joined into fewer, larger pieces. The reply is read in a
+        separate thread, so that text received before a pause in the stream is not
+        held back until the next chunk arrives. The chunks are also appended to
+        `reply_chunks` as they arrive.
+        """
+        chunks_queue = queue.Queue()
+
+        def read_reply():
+            try:
+                for chunk in self.chat_obj.answer_question(self.prompt):
+                    chunks_queue.put(chunk)
+            except Exception as error:  # noqa: BLE001
+                chunks_queue.put(error)
+            finally:
+                chunks_queue.put(None)
+
+        reader_thread = threading.Thread(name="read_text_reply", target=read_reply)
+        add_script_run_ctx(reader_thread)
+        reader_thread.start()
+
+        text_to_yield = []
+        last_yield_time = time.monotonic()
+        while True:
+            # Only wait for new chunks until pending text, if any, is due to be yielded
+            next_yield_time = last_yield_time + self.min_render_interval
+            timeout = (
+                max(next_yield_time - time.monotonic(), 0) if text_to_yield else None
+            )
+            try:
+                item = chunks_queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    reader_thread.join()
+                    raise item
+                reply_chunks.append(item)
+                text_to_yield.append(item.content)
+
+            if text_to_yield and time.monotonic() >= next_yield_time:
+                yield "".join(text_to_yield)
+                text_to_yield.clear()
+                last_yield_time = time.monotonic()
+
+        reader_thread.join()
+        if text_to_yield:
+            yield "".join(text_to_yield)
 
     def play_queued_audios(self):
         """Play queued audio segments."""
@@ -105,38 +160,37 @@ class AsyncReplier:
                 )
                 logger.error(error)
                 break
-            finally:
-                self.app_page.status_msg_container.empty()
+
+        # Each hidden player replaces the previous one in the single-element status
+        # container, so it only needs clearing once all the audios have been played
+        self.app_page.status_msg_container.empty()
 
     def stream_text_and_audio_reply(self):
         """Stream the text and audio reply to the display."""
         text_reply_container = st.empty()
         audio_reply_container = st.empty()
 
-        chunk = AssistantResponseChunk(exchange_id=None, content="")
-        full_response = ""
-        text_reply_container.markdown("▌")
         self.app_page.status_msg_container.empty()
-        while chunk.content is not None:
-            logger.trace("Waiting for text or audio chunks...")
-            # Render text
-            with contextlib.suppress(queue.Empty):
-                chunk = self.question_answer_chunks_queue.get_nowait()
-                if chunk.content is not None:
-                    full_response += chunk.content
-                    text_reply_container.markdown(full_response + "▌")
-                self.question_answer_chunks_queue.task_done()
+        reply_chunks = []
+        text_reply_container.write_stream(self.text_reply_batches(reply_chunks))
 
+        full_response = "".join(chunk.content for chunk in reply_chunks)
         text_reply_container.caption(datetime.datetime.now().replace(microsecond=0))
         text_reply_container.markdown(full_response)
 
+        # Wait for the queues in the order they feed each other, so that each join
+        # only returns once all of the reply's items have reached the next queue
+        logger.debug("Waiting for the audio reply to be converted...")
+        self.chat_obj.tts_conversion_queue.join()
         logger.debug("Waiting for the audio reply to finish...")
         self.chat_obj.play_speech_queue.join()
+        logger.debug("Waiting for the audio reply to be saved...")
+        self.chat_obj.current_answer_audios_queue.join()
 
         logger.debug("Getting path to full audio file for the reply...")
         history_entry_for_this_reply = (
             self.chat_obj.context_handler.database.retrieve_history(
-                exchange_id=chunk.exchange_id
+                exchange_id=reply_chunks[-1].exchange_id if reply_chunks else None
             )
         )
         full_audio_fpath = history_entry_for_this_reply["reply_audio_file_path"].iloc[0]
@@ -151,6 +205,24 @@ class AsyncReplier:
         return {"text": full_response, "audio": full_audio_fpath}
 
 
+def encode_audio_segment(audio: AudioSegment, max_wav_duration_seconds: float = 5.0):
+    """Encode `audio` for playback in the browser. Return the data and its mime type.
+
+    Short segments are written as WAV straight from their PCM data, which avoids
+    spawning ffmpeg. Longer ones are exported as MP3 to keep their size down.
+    """
+    if audio.duration_seconds > max_wav_duration_seconds:
+        return audio.export(format="mp3").read(), "audio/mpeg"
+
+    wav_buffer = io.BytesIO()
+    with wave.open(wav_buffer, "wb") as wav_file:
+        wav_file.setnchannels(audio.channels)
+        wav_file.setsampwidth(audio.sample_width)
+        wav_file.setframerate(audio.frame_rate)
+        wav_file.writeframes(audio.raw_data)
+    return wav_buffer.getvalue(), "audio/wav"
+
+
 @st.cache_data
 def get_ice_servers():
     """Use Twilio's TURN server as recommended by the streamlit-webrtc developers."""
@@ -170,7 +242,7 @@ def get_ice_servers():
 
 
 def filter_page_info_from_queue(app_page: "AppPage", the_queue: queue.Queue):
-    """Filter `app_page`'s data from `queue` inplace. Return queue of items in `app_page`.
+    """Filter `app_page`'s data from `queue` inplace. Return deque of items in `app_page`.
 
     **Use with original_queue.mutex!!**
 
@@ -179,28 +251,44 @@ def filter_page_info_from_queue(app_page: "AppPage", the_queue: queue.Queue):
         the_queue: The queue to be filtered.
 
     Returns:
-        queue.Queue: The queue with only the entries from `app_page`.
+        collections.deque: The entries from `app_page`, in their original order.
 
     Example:
     ```
     with the_queue.mutex:
-        this_page_data = remove_page_info_from_queue(app_page, the_queue)
+        this_page_data = filter_page_info_from_queue(app_page, the_queue)
     ```
     """
-    queue_with_only_entries_from_other_pages = queue.Queue()
-    items_from_page_queue = queue.Queue()
-    while the_queue.queue:
-        original_queue_entry = the_queue.queue.popleft()
-        if original_queue_entry["page"].page_id == app_page.page_id:
-            items_from_page_queue.put(original_queue_entry)
+    items_from_page = collections.deque()
+    items_from_other_pages = collections.deque()
+    for queue_entry in the_queue.queue:
+        if queue_entry["page"].page_id == app_page.page_id:
+            items_from_page.append(queue_entry)
         else:
-            queue_with_only_entries_from_other_pages.put(original_queue_entry)
+            items_from_other_pages.append(queue_entry)
 
-    the_queue.queue = queue_with_only_entries_from_other_pages.queue
-    return items_from_page_queue
+    the_queue.queue = items_from_other_pages
+    return items_from_page
 
 
-@st.cache_data
+def get_usage_balance_dataframe(token_usage_db: TokenUsageDatabase):
+    """Return the token usage dataframe for `token_usage_db`, reusing it across reruns."""
+    return _get_usage_balance_dataframe(
+        token_usage_db,
+        fpath=token_usage_db.fpath,
+        data_version=token_usage_db.data_version,
+    )
+
+
+@st.cache_data(max_entries=32)
+def _get_usage_balance_dataframe(
+    _token_usage_db: TokenUsageDatabase, fpath, data_version  # noqa: ARG001
+):
+    # The dataframe is only rebuilt when the usage recorded in the db at `fpath` changes
+    return _token_usage_db.get_usage_balance_dataframe()
+
+
+@st.cache_resource
 def get_avatar_images():
     """Return the avatar images for the assistant and the user."""
     avatar_files_dir = GeneralDefinitions.APP_DIR / "data"
@@ -212,9 +300,28 @@ def get_avatar_images():
     return {"assistant": assistant_avatar_image, "user": user_avatar_image}
 
 
-@st.cache_data
+@st.cache_resource
 def load_chime(chime_type: str) -> AudioSegment:
     """Load a chime sound from the data directory."""
     return AudioSegment.from_file(
         GeneralDefinitions.APP_DIR / "data" / f"{chime_type}.wav", format="wav"
     )
+
+
+@st.cache_resource
+def load_chime_mp3_base64(chime_type: str) -> str:
+    """Return the chime sound of type `chime_type` as base64-encoded mp3 data."""
+    mp3_data = load_chime(chime_type).export(format="mp3").read()
+    return base64.b64encode(mp3_data).decode()
+
+
+def load_audio_file(fpath: str) -> bytes:
+    """Return the contents of the audio file at `fpath`, cached across reruns."""
+    stat = Path(fpath).stat()
+    return _load_audio_file(fpath, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _load_audio_file(fpath: str, mtime_ns: int, size: int) -> bytes:  # noqa: ARG001
+    # Keyed on the file's modification time and size, so a rewritten file is read again
+    return Path(fpath).read_bytes()
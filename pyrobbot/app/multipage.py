@@ -2,6 +2,7 @@
 
 import contextlib
 import datetime
+import functools
 import hashlib
 import os
 import queue
@@ -10,7 +11,6 @@ import threading
 import time
 from abc import ABC, abstractmethod, abstractproperty
 from collections import defaultdict, deque
-from json.decoder import JSONDecodeError
 
 import streamlit as st
 import streamlit_webrtc
@@ -197,8 +197,7 @@ def handle_continuous_user_prompt():
                     this_page_audio_chunks = filter_page_info_from_queue(
                         app_page=app_page, the_queue=audio_playing_chunks_queue
                     )
-                    while this_page_audio_chunks.queue:
-                        audio_chunk_info = this_page_audio_chunks.queue.popleft()
+                    for audio_chunk_info in this_page_audio_chunks:
                         concatenated_audio += audio_chunk_info["audio"]
 
                 logger.debug(
@@ -517,10 +516,10 @@ class MultipageChatbotApp(AbstractMultipageApp):
         if "chat_configs" not in self.state:
             try:
                 chat_options_file_path = sys.argv[-1]
-                self.state["chat_configs"] = VoiceChatConfigs.from_file(
+                self.state["chat_configs"] = _load_chat_configs_from_file(
                     chat_options_file_path
-                )
-            except (FileNotFoundError, JSONDecodeError):
+                ).model_copy(deep=True)
+            except (FileNotFoundError, ValidationError):
                 logger.warning("Could not retrieve cli args. Using default chat options.")
                 self.state["chat_configs"] = VoiceChatConfigs()
         return self.state["chat_configs"]
@@ -906,3 +905,9 @@ def _set_button_style():
         """,
         unsafe_allow_html=True,
     )
+
+
+@functools.lru_cache(maxsize=1)
+def _load_chat_configs_from_file(fpath: str) -> VoiceChatConfigs:
+    """Read the configs passed to the app only once per process."""
+    return VoiceChatConfigs.from_file(fpath)
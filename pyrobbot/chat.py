@@ -3,6 +3,7 @@
 import contextlib
 import json
 import shutil
+import sqlite3
 import uuid
 from collections import defaultdict
 from datetime import datetime
@@ -75,6 +76,9 @@ class Chat(AlternativeConstructors):
         for field in self._passed_configs.model_fields:
             setattr(self, field, self._passed_configs[field])
 
+        # Token usage databases by file path, reused so they can buffer their writes
+        self._token_usage_dbs = {}
+
         try:
             self.openai_client = (
                 openai_client
@@ -164,7 +168,7 @@ class Chat(AlternativeConstructors):
     @property
     def token_usage_db(self):
         """Return the chat's token usage database."""
-        return TokenUsageDatabase(fpath=self.cache_dir / "chat_token_usage.db")
+        return self._get_token_usage_db(fpath=self.cache_dir / "chat_token_usage.db")
 
     @property
     def general_token_usage_db(self):
@@ -173,7 +177,7 @@ class Chat(AlternativeConstructors):
         Even private-mode chats will use this database to keep track of total token usage.
         """
         general_cache_dir = self.openai_client.get_cache_dir(private_mode=False)
-        return TokenUsageDatabase(fpath=general_cache_dir.parent / "token_usage.db")
+        return self._get_token_usage_db(fpath=general_cache_dir.parent / "token_usage.db")
 
     @property
     def metadata_file(self):
@@ -209,7 +213,12 @@ class Chat(AlternativeConstructors):
     def clear_cache(self):
         """Remove the cache directory."""
         logger.debug("Clearing cache for chat {}", self.id)
-        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        cache_dir = self.cache_dir
+        token_usage_dbs = self._token_usage_dbs
+        for fpath in [fpath for fpath in token_usage_dbs if cache_dir in fpath.parents]:
+            with contextlib.suppress(sqlite3.Error):
+                token_usage_dbs.pop(fpath).close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
 
     def load_history(self):
         """Load chat history from cache."""
@@ -279,6 +288,10 @@ class Chat(AlternativeConstructors):
 
         except (ReachedMaxNumberOfAttemptsError, openai.OpenAIError) as error:
             yield self.response_failure_message(exchange_id=exchange_id, error=error)
+        finally:
+            # Persist the token usage accumulated during this chat turn
+            for db in self._token_usage_dbs.values():
+                db.flush()
 
     def start(self):
         """Start the chat."""
@@ -361,15 +374,23 @@ class Chat(AlternativeConstructors):
         prompt_msg: dict,
         add_to_history: bool = True,
         skip_check: bool = False,
+        use_context: bool = True,
+        **api_call_kwargs,
     ):
-        """Yield response from a prompt message (lower level interface)."""
+        """Yield response from a prompt message (lower level interface).
+
+        Any `api_call_kwargs` (e.g., `max_tokens`) are passed on to
+        `make_api_chat_completion_call`.
+        """
         # Get appropriate context for prompt from the context handler
-        context = self.context_handler.get_context(msg=prompt_msg)
+        context = self.context_handler.get_context(msg=prompt_msg) if use_context else []
 
         # Make API request and yield response chunks
         full_reply_content = ""
         for chunk in make_api_chat_completion_call(
-            conversation=[self.base_directive, *context, prompt_msg], chat_obj=self
+            conversation=[self.base_directive, *context, prompt_msg],
+            chat_obj=self,
+            **api_call_kwargs,
         ):
             full_reply_content += chunk.strip(self._code_marker)
             yield chunk
@@ -463,6 +484,15 @@ class Chat(AlternativeConstructors):
                 ],
             )
 
+    def _get_token_usage_db(self, fpath: Path):
+        """Return the token usage database stored at `fpath`, reusing earlier instances.
+
+        Reusing the instances allows the databases to buffer writes between flushes.
+        """
+        if fpath not in self._token_usage_dbs:
+            self._token_usage_dbs[fpath] = TokenUsageDatabase(fpath=fpath)
+        return self._token_usage_dbs[fpath]
+
     def _respond_prompt(self, prompt: str, role: str, **kwargs):
         prompt_as_msg = {"role": role.lower().strip(), "content": prompt.strip()}
         yield from self.yield_response_from_msg(prompt_as_msg, **kwargs)
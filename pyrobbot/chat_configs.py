@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 """Registration and validation of options."""
 import argparse
-import json
 import types
 import typing
 from getpass import getuser
@@ -78,8 +77,8 @@ class BaseConfigModel(BaseModel, extra="forbid"):
     @classmethod
     def from_file(cls, fpath: Path):
         """Return an instance of the class given configs stored in a json file."""
-        with open(fpath, "r") as configs_file:
-            return cls.model_validate(json.load(configs_file))
+        # Let pydantic parse the json itself, without building an intermediate dict
+        return cls.model_validate_json(Path(fpath).read_bytes())
 
 
 class OpenAiApiCallOptions(BaseConfigModel):
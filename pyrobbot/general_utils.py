@@ -20,9 +20,12 @@ class ReachedMaxNumberOfAttemptsError(Exception):
     """Error raised when the max number of attempts has been reached."""
 
 
+_NON_ALPHANUMERIC_RUNS_REGEX = re.compile("[^0-9a-zA-Z]+")
+
+
 def _get_lower_alphanumeric(string: str):
     """Return a string with only lowercase alphanumeric characters."""
-    return re.sub("[^0-9a-zA-Z]+", " ", string.strip().lower())
+    return _NON_ALPHANUMERIC_RUNS_REGEX.sub(" ", string.strip().lower())
 
 
 def str2_minus_str1(str1: str, str2: str):
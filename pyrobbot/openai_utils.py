@@ -72,12 +72,15 @@ class OpenAiClientWrapper(openai.OpenAI):
         return directory
 
 
-def make_api_chat_completion_call(conversation: list, chat_obj: "Chat"):
+def make_api_chat_completion_call(
+    conversation: list, chat_obj: "Chat", max_tokens: Optional[int] = None
+):
     """Stream a chat completion from OpenAI API given a conversation and a chat object.
 
     Args:
         conversation (list): A list of messages passed as input for the completion.
         chat_obj (Chat): Chat object containing the configurations for the chat.
+        max_tokens (int, optional): Overrides the chat's `max_tokens` for this call.
 
     Yields:
         str: Chunks of text generated by the API in response to the conversation.
@@ -86,6 +89,8 @@ def make_api_chat_completion_call(conversation: list, chat_obj: "Chat"):
     for field in OpenAiApiCallOptions.model_fields:
         if getattr(chat_obj, field) is not None:
             api_call_args[field] = getattr(chat_obj, field)
+    if max_tokens is not None:
+        api_call_args["max_tokens"] = max_tokens
 
     logger.trace(
         "Making OpenAI API call with chat=<{}>, args {} and messages {}",
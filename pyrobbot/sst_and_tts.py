@@ -126,6 +126,8 @@ class SpeechToText(SpeechAndTextConfigs):
                 model="whisper-1",
                 n_input_tokens=int(np.ceil(self.speech.duration_seconds)),
             )
+            # This may run outside of a chat turn, after its usage has been flushed
+            db.flush()
 
         return transcript.text
 
@@ -154,6 +156,11 @@ class TextToSpeech(SpeechAndTextConfigs):
             self._speech = self._tts()
         return self._speech
 
+    @speech.setter
+    def speech(self, value: AudioSegment):
+        """Set the speech for the text, e.g., to reuse speech converted earlier."""
+        self._speech = value
+
     def set_sample_rate(self, sample_rate: int):
         """Set the sample rate of the speech."""
         self._speech = self.speech.set_frame_rate(sample_rate)
@@ -176,6 +183,8 @@ class TextToSpeech(SpeechAndTextConfigs):
                 self.token_usage_db,
             ]:
                 db.insert_data(model=openai_tts_model, n_input_tokens=len(self.text))
+                # This may run outside of a chat turn, after its usage has been flushed
+                db.flush()
             return self.openai_client.audio.speech.create(*args, **kwargs)
 
         response = _create_speech(
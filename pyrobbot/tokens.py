@@ -1,11 +1,14 @@
 """Management of token usage and costs for OpenAI API."""
 
 import contextlib
-import datetime
+import functools
 import sqlite3
+import threading
+import time
 from pathlib import Path
 from typing import Optional
 
+import numpy as np
 import pandas as pd
 import tiktoken
 
@@ -52,24 +55,48 @@ PRICE_PER_K_TOKENS = (
 class TokenUsageDatabase:
     """Manages a database to store estimated token usage and costs for OpenAI API."""
 
-    def __init__(self, fpath: Path):
-        """Initialize a TokenUsageDatabase instance."""
+    def __init__(self, fpath: Path, max_pending_rows: int = 32):
+        """Initialize a TokenUsageDatabase instance.
+
+        Args:
+            fpath (Path): The path to the SQLite database file.
+            max_pending_rows (int, optional): Number of buffered rows that triggers a
+                flush to the database. Defaults to 32.
+        """
         self.fpath = fpath
-        self.token_price = {}
-        for model, price_per_k_tokens in PRICE_PER_K_TOKENS.items():
-            self.token_price[model] = {
-                k: v / 1000.0 for k, v in price_per_k_tokens.items()
-            }
+        self.max_pending_rows = max_pending_rows
+        self._pending = []
+        self._conn = None
+        self._lock = threading.Lock()
+
+        # Per-token (input, output) prices, one row per model, for vectorised cost math
+        self._model_index = {model: i for i, model in enumerate(PRICE_PER_K_TOKENS)}
+        self._prices = (
+            np.array(
+                [(p["input"], p["output"]) for p in PRICE_PER_K_TOKENS.values()],
+                dtype=np.float64,
+            )
+            / 1000.0
+        )
+        self.token_price = {
+            model: {"input": input_price, "output": output_price}
+            for model, (input_price, output_price) in zip(
+                PRICE_PER_K_TOKENS, self._prices.tolist()
+            )
+        }
 
         self.create()
 
     def create(self):
         """Create the database if it doesn't exist."""
         self.fpath.parent.mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(self.fpath)
-        cursor = conn.cursor()
+        cursor = self.conn.cursor()
+
+        # WAL mode is persistent, so it only needs to be set when creating the db
+        cursor.execute("PRAGMA journal_mode=WAL")
 
-        # Create a table to store the data with 'timestamp' as the primary key
+        # Create a table to store the data. Several rows can share the same timestamp,
+        # so there is no primary key and rows are always plainly inserted.
         cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS token_costs (
@@ -82,9 +109,45 @@ class TokenUsageDatabase:
             )
         """
         )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_token_costs_model_timestamp
+            ON token_costs (model, timestamp)
+        """
+        )
 
-        conn.commit()
-        conn.close()
+        # Running per-model totals, kept up to date on every flush so that reading the
+        # accumulated usage doesn't need to scan the whole token_costs table
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS token_cost_totals (
+                model TEXT PRIMARY KEY NOT NULL,
+                first_used INTEGER NOT NULL,
+                n_input_tokens INTEGER NOT NULL,
+                n_output_tokens INTEGER NOT NULL,
+                cost_input_tokens REAL NOT NULL,
+                cost_output_tokens REAL NOT NULL
+            )
+        """
+        )
+        # Backfill the totals for databases created before the totals table existed
+        cursor.execute(
+            """
+            INSERT INTO token_cost_totals
+            SELECT
+                model,
+                MIN(timestamp),
+                SUM(n_input_tokens),
+                SUM(n_output_tokens),
+                SUM(cost_input_tokens),
+                SUM(cost_output_tokens)
+            FROM token_costs
+            WHERE NOT EXISTS (SELECT 1 FROM token_cost_totals)
+            GROUP BY model
+        """
+        )
+
+        self.conn.commit()
 
     def insert_data(
         self,
@@ -93,63 +156,148 @@ class TokenUsageDatabase:
         n_output_tokens: int = 0,
         timestamp: Optional[int] = None,
     ):
-        """Insert the data into the token_costs table."""
+        """Buffer data to be inserted into the token_costs table.
+
+        Buffered rows are written to the database by `flush`, which is called
+        automatically once `max_pending_rows` rows have been buffered.
+        """
         if model is None:
             return
 
-        conn = sqlite3.connect(self.fpath)
-        cursor = conn.cursor()
-
-        # Insert the data into the table
-        cursor.execute(
-            """
-        INSERT INTO token_costs (
-            timestamp,
+        row = (
+            timestamp or int(time.time()),
             model,
             n_input_tokens,
             n_output_tokens,
-            cost_input_tokens,
-            cost_output_tokens
+            n_input_tokens * self.token_price[model]["input"],
+            n_output_tokens * self.token_price[model]["output"],
         )
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-            (
-                timestamp or int(datetime.datetime.utcnow().timestamp()),
+        # Chats insert data from several threads
+        with self._lock:
+            self._pending.append(row)
+            buffer_is_full = len(self._pending) >= self.max_pending_rows
+        if buffer_is_full:
+            self.flush()
+
+    def insert_many(self, rows: list[tuple]):
+        """Insert several rows of data into the token_costs table in one transaction.
+
+        Args:
+            rows (list[tuple]): Tuples `(model, n_input_tokens, n_output_tokens)`,
+                optionally followed by a `timestamp`, as in `insert_data`.
+        """
+        rows = [row for row in rows if row[0] is not None]
+        if not rows:
+            return
+
+        now = int(time.time())
+        models, timestamps, n_tokens = [], [], []
+        for model, n_input_tokens, n_output_tokens, *timestamp in rows:
+            models.append(model)
+            timestamps.append(timestamp[0] if timestamp and timestamp[0] else now)
+            n_tokens.append((n_input_tokens, n_output_tokens))
+
+        n_tokens = np.array(n_tokens, dtype=np.int64)
+        costs = n_tokens * self._prices[[self._model_index[m] for m in models]]
+
+        with self._lock:
+            self._pending.extend(
+                zip(
+                    timestamps,
+                    models,
+                    n_tokens[:, 0].tolist(),
+                    n_tokens[:, 1].tolist(),
+                    costs[:, 0].tolist(),
+                    costs[:, 1].tolist(),
+                )
+            )
+        self.flush()
+
+    def flush(self):
+        """Write all buffered data to the database in a single transaction."""
+        # Take the buffered rows and write them under the same lock, so that every row
+        # ends up written exactly once, and in both tables
+        with self._lock:
+            pending_rows, self._pending = self._pending, []
+            if not pending_rows:
+                return
+            self._write_rows(pending_rows)
+
+    def _write_rows(self, rows: list[tuple]):
+        with self.conn:
+            self.conn.executemany(
+                """
+            INSERT INTO token_costs (
+                timestamp,
                 model,
                 n_input_tokens,
                 n_output_tokens,
-                n_input_tokens * self.token_price[model]["input"],
-                n_output_tokens * self.token_price[model]["output"],
-            ),
-        )
-
-        conn.commit()
-        conn.close()
+                cost_input_tokens,
+                cost_output_tokens
+            )
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                rows,
+            )
+            self.conn.executemany(
+                """
+            INSERT INTO token_cost_totals (
+                first_used,
+                model,
+                n_input_tokens,
+                n_output_tokens,
+                cost_input_tokens,
+                cost_output_tokens
+            )
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (model) DO UPDATE SET
+                first_used = MIN(first_used, excluded.first_used),
+                n_input_tokens = n_input_tokens + excluded.n_input_tokens,
+                n_output_tokens = n_output_tokens + excluded.n_output_tokens,
+                cost_input_tokens = cost_input_tokens + excluded.cost_input_tokens,
+                cost_output_tokens = cost_output_tokens + excluded.cost_output_tokens
+            """,
+                rows,
+            )
 
     def get_usage_balance_dataframe(self):
         """Get a dataframe with the accumulated token usage and costs."""
-        conn = sqlite3.connect(self.fpath)
+        self.flush()
         query = """
             SELECT
-                model as Model,
-                MIN(timestamp) AS "First Used",
-                SUM(n_input_tokens) AS "Tokens: In",
-                SUM(n_output_tokens) AS "Tokens: Out",
-                SUM(n_input_tokens + n_output_tokens) AS "Tokens: Tot.",
-                SUM(cost_input_tokens) AS "Cost ($): In",
-                SUM(cost_output_tokens) AS "Cost ($): Out",
-                SUM(cost_input_tokens + cost_output_tokens) AS "Cost ($): Tot."
-            FROM token_costs
-            GROUP BY model
-            ORDER BY "Cost ($): Tot." DESC
+                model,
+                first_used,
+                n_input_tokens,
+                n_output_tokens,
+                cost_input_tokens,
+                cost_output_tokens
+            FROM token_cost_totals
+            ORDER BY cost_input_tokens + cost_output_tokens DESC
         """
+        with self._lock:
+            rows = self.conn.execute(query).fetchall()
 
-        usage_df = pd.read_sql_query(query, con=conn)
-        conn.close()
-
-        usage_df["First Used"] = pd.to_datetime(usage_df["First Used"], unit="s")
+        # Build the dataframe column-wise, computing the totals in a vectorised way
+        models, first_used, n_in, n_out, cost_in, cost_out = (
+            np.array(column) for column in (zip(*rows) if rows else [()] * 6)
+        )
+        usage_df = pd.DataFrame(
+            {
+                "Model": models,
+                "First Used": pd.to_datetime(first_used, unit="s"),
+                "Tokens: In": n_in,
+                "Tokens: Out": n_out,
+                "Tokens: Tot.": n_in + n_out,
+                "Cost ($): In": cost_in,
+                "Cost ($): Out": cost_out,
+                "Cost ($): Tot.": cost_in + cost_out,
+            }
+        )
 
-        usage_df = _group_columns_by_prefix(_add_totals_row(usage_df))
+        # There is nothing to sum up if no usage has been recorded yet
+        if rows:
+            usage_df = _add_totals_row(usage_df)
+        usage_df = _group_columns_by_prefix(usage_df)
 
         # Add metadata to returned dataframe
         usage_df.attrs["description"] = "Estimated token usage and associated costs"
@@ -162,14 +310,58 @@ class TokenUsageDatabase:
 
         return usage_df
 
+    @property
+    def data_version(self) -> tuple:
+        """Return a value that changes whenever the usage data in the database changes.
+
+        The value is read from the database contents (after flushing any buffered
+        data), so it is the same for all instances using the same database file.
+        """
+        self.flush()
+        query = """
+            SELECT COUNT(*), TOTAL(n_input_tokens), TOTAL(n_output_tokens)
+            FROM token_cost_totals
+        """
+        with self._lock:
+            return self.conn.execute(query).fetchone()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Return the connection to the database, kept open for the instance's lifetime.
+
+        Keeping the connection open preserves SQLite's page cache between calls.
+        """
+        if self._conn is None:
+            # Chats access their databases from several threads. Access to the
+            # connection is serialised via self._lock.
+            self._conn = sqlite3.connect(self.fpath, check_same_thread=False)
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA temp_store=MEMORY")
+            self._conn.execute("PRAGMA cache_size=-64000")
+        return self._conn
+
+    def close(self):
+        """Write any buffered data and close the connection to the database."""
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+
+    def __del__(self):
+        """Write any buffered data and close the connection before discarding."""
+        # The db file may be gone already, e.g., if the chat's cache has been cleared
+        with contextlib.suppress(sqlite3.Error, AttributeError):
+            self.close()
+
 
 def get_n_tokens_from_msgs(messages: list[dict], model: str):
     """Returns the number of tokens used by a list of messages."""
     # Adapted from
     # <https://platform.openai.com/docs/guides/text-generation/managing-tokens>
-    encoding = tiktoken.get_encoding("cl100k_base")
-    with contextlib.suppress(KeyError):
-        encoding = tiktoken.encoding_for_model(model)
+    encoding = _get_encoding_for_model(model)
 
     # OpenAI's original function was implemented for gpt-3.5-turbo-0613, but we'll use
     # it for all models for now. We are only interested in estimates, after all.
@@ -189,16 +381,44 @@ def get_n_tokens_from_msgs(messages: list[dict], model: str):
     return num_tokens
 
 
+def truncate_to_last_n_tokens(text: str, model: str, n_tokens: int):
+    """Return the trailing part of `text` that fits in `n_tokens` tokens for `model`."""
+    encoding = _get_encoding_for_model(model)
+    tokens = encoding.encode(text)
+    if len(tokens) <= n_tokens:
+        return text
+    return encoding.decode(tokens[-n_tokens:])
+
+
+@functools.lru_cache(maxsize=8)
+def _get_encoding_for_model(model: str):
+    """Return the tiktoken encoding for `model`, falling back to `cl100k_base`."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 def _group_columns_by_prefix(dataframe: pd.DataFrame):
-    dataframe = dataframe.copy()
-    col_tuples_for_multiindex = dataframe.columns.str.split(": ", expand=True).to_numpy()
-    dataframe.columns = pd.MultiIndex.from_tuples(
+    dataframe.columns = _get_multiindex_from_prefixed_columns(tuple(dataframe.columns))
+    return dataframe
+
+
+@functools.lru_cache(maxsize=8)
+def _get_multiindex_from_prefixed_columns(columns: tuple[str, ...]):
+    """Return a MultiIndex grouping `columns` by their "prefix: " (cached per schema)."""
+    col_tuples_for_multiindex = pd.Index(columns).str.split(": ", expand=True).to_numpy()
+    return pd.MultiIndex.from_tuples(
         [("", x[0]) if pd.isna(x[1]) else x for x in col_tuples_for_multiindex]
     )
-    return dataframe
 
 
 def _add_totals_row(accounting_df: pd.DataFrame):
-    dtypes = accounting_df.dtypes
-    sums_df = accounting_df.sum(numeric_only=True).rename("Total").to_frame().T
-    return pd.concat([accounting_df, sums_df]).astype(dtypes).fillna(" ")
+    # Sum column by column, as a single series of sums would turn the ints into floats.
+    # Fill in the non-summed columns directly so that concat keeps the original dtypes.
+    numeric_columns = accounting_df.select_dtypes("number").columns
+    totals_row = {
+        column: accounting_df[column].sum() if column in numeric_columns else " "
+        for column in accounting_df.columns
+    }
+    return pd.concat([accounting_df, pd.DataFrame([totals_row], index=["Total"])])
@@ -3,9 +3,10 @@
 import contextlib
 import io
 import queue
+import re
 import threading
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
 
 import chime
@@ -44,11 +45,21 @@ except (ImportError, OSError, FileNotFoundError) as error:
 else:
     _pydub_usable = True
 
+# Sentence-ending punctuation, but not a dot after a digit, to avoid splitting numbers
+_SENTENCE_END_REGEX = re.compile(r"(?:[!?]|(?<!\d)\.)\s*$")
+
 
 class VoiceChat(Chat):
     """Class for converting text to speech and speech to text."""
 
+    # Speech for recently converted texts, shared by all chats. Replies often repeat
+    # some sentences (e.g., greetings or the notice about code in the reply)
+    _tts_speech_cache = OrderedDict()
+    _tts_speech_cache_lock = threading.Lock()
+    tts_speech_cache_size = 32
     default_configs = VoiceChatConfigs()
+    # Min number of characters, after the first sentence, sent in each TTS request
+    min_tts_text_length = 120
 
     def __init__(self, configs: VoiceChatConfigs = default_configs, **kwargs):
         """Initializes a chat instance."""
@@ -58,6 +69,10 @@ class VoiceChat(Chat):
         self.block_size = int((self.sample_rate * self.frame_duration) / 1000)
 
         self.vad = webrtcvad.Vad(2)
+        # The exit expressions can't be changed, so normalize them only once
+        self._normalized_exit_expressions = tuple(
+            _get_lower_alphanumeric(expr) for expr in self.exit_expressions
+        )
 
         self.default_chime_theme = "big-sur"
         chime.theme(self.default_chime_theme)
@@ -78,11 +93,7 @@ class VoiceChat(Chat):
             args=(self.tts_conversion_queue,),
             daemon=True,
         )
-        self.play_speech_thread = threading.Thread(
-            target=self.handle_play_speech_queue,
-            args=(self.play_speech_queue,),
-            daemon=True,
-        )  # TODO: Do not start this in webchat
+        self.play_speech_thread = self._build_play_speech_thread()
         # 3. Watching for expressions that cancel the reply or exit the chat
         self.check_for_interrupt_expressions_queue = queue.Queue()
         self.check_for_interrupt_expressions_thread = threading.Thread(
@@ -101,6 +112,37 @@ class VoiceChat(Chat):
             daemon=True,
         )
 
+    def _build_play_speech_thread(self):
+        """Return the thread that plays the speech queued for the assistant's replies."""
+        return threading.Thread(
+            target=self.handle_play_speech_queue,
+            args=(self.play_speech_queue,),
+            daemon=True,
+        )
+
+    def _tts_with_cache(self, text: str) -> TextToSpeech:
+        """Convert text to audio, reusing the speech if the text was converted before."""
+        tts_obj = self.tts(text)
+        cache_key = (self.tts_engine, self.openai_tts_voice, self.language, tts_obj.text)
+        cache = type(self)._tts_speech_cache  # noqa: SLF001
+        with type(self)._tts_speech_cache_lock:  # noqa: SLF001
+            cached_speech = cache.get(cache_key)
+            if cached_speech is not None:
+                cache.move_to_end(cache_key)
+
+        if cached_speech is None:
+            # Trigger the TTS conversion
+            speech = tts_obj.speech
+            with type(self)._tts_speech_cache_lock:  # noqa: SLF001
+                cache[cache_key] = speech
+                while len(cache) > self.tts_speech_cache_size:
+                    cache.popitem(last=False)
+        else:
+            logger.debug("Reusing the speech for '{}'", tts_obj.text)
+            tts_obj.speech = cached_speech
+
+        return tts_obj
+
     @property
     def mixer(self):
         """Return the mixer object."""
@@ -125,7 +167,8 @@ class VoiceChat(Chat):
         """Start the chat."""
         # ruff: noqa: T201
         self.tts_conversion_watcher_thread.start()
-        self.play_speech_thread.start()
+        if self.play_speech_thread is not None:
+            self.play_speech_thread.start()
         if not self.skip_initial_greeting:
             tts_entry = {"exchange_id": self.id, "text": self.initial_greeting}
             self.tts_conversion_queue.put(tts_entry)
@@ -145,12 +188,10 @@ class VoiceChat(Chat):
                     logger.opt(colors=True).debug(
                         "<yellow>Interrupting the reply</yellow>"
                     )
-                    with self.check_for_interrupt_expressions_queue.mutex:
-                        self.check_for_interrupt_expressions_queue.queue.clear()
+                    _drain_queue(self.check_for_interrupt_expressions_queue)
                     with contextlib.suppress(pygame.error):
                         self.mixer.stop()
-                    with self.questions_queue.mutex:
-                        self.questions_queue.queue.clear()
+                    _drain_queue(self.questions_queue)
                     chime.theme("material")
                     chime.error()
                     chime.theme(self.default_chime_theme)
@@ -178,6 +219,10 @@ class VoiceChat(Chat):
         """Answer a question."""
         logger.debug("{}> Getting response to '{}'...", self.assistant_name, question)
         sentence_for_tts = ""
+        # Complete sentences not yet sent for TTS. They are sent in groups, to save on
+        # TTS requests, except for the first one, so that speech starts early
+        text_for_tts = ""
+        any_text_sent_for_tts_yet = False
         any_code_chunk_yet = False
         for answer_chunk in self.respond_user_prompt(prompt=question):
             if self.interrupt_reply.is_set() or self.exit_chat.is_set():
@@ -194,31 +239,42 @@ class VoiceChat(Chat):
                 if answer_chunk.chunk_type == "text":
                     # The answer chunk is to be spoken
                     sentence_for_tts += answer_chunk.content
-                    stripd_chunk = answer_chunk.content.strip()
-                    if stripd_chunk.endswith(("?", "!", ".")):
-                        # Check if second last character is a number, to avoid splitting
-                        if stripd_chunk.endswith("."):
-                            with contextlib.suppress(IndexError):
-                                previous_char = sentence_for_tts.strip()[-2]
-                                if previous_char.isdigit():
-                                    continue
-                        # Send sentence for TTS even if the request hasn't finished
+                    # Only the chunk's own text needs checking for a sentence ending
+                    chunk_start = len(sentence_for_tts) - len(answer_chunk.content)
+                    if _SENTENCE_END_REGEX.search(sentence_for_tts, chunk_start):
+                        text_for_tts += sentence_for_tts
+                        sentence_for_tts = ""
+                        if (
+                            not any_text_sent_for_tts_yet
+                            or len(text_for_tts) >= self.min_tts_text_length
+                        ):
+                            # Send text for TTS even if the request hasn't finished
+                            tts_entry = {
+                                "exchange_id": answer_chunk.exchange_id,
+                                "text": text_for_tts,
+                            }
+                            self.tts_conversion_queue.put(tts_entry)
+                            text_for_tts = ""
+                            any_text_sent_for_tts_yet = True
+                elif answer_chunk.chunk_type == "code" and not any_code_chunk_yet:
+                    if text_for_tts:
+                        # Make sure the text before the code is spoken first
                         tts_entry = {
                             "exchange_id": answer_chunk.exchange_id,
-                            "text": sentence_for_tts,
+                            "text": text_for_tts,
                         }
                         self.tts_conversion_queue.put(tts_entry)
-                        sentence_for_tts = ""
-                elif answer_chunk.chunk_type == "code" and not any_code_chunk_yet:
+                        text_for_tts = ""
                     msg = self._translate("Code will be displayed in the text output.")
                     tts_entry = {"exchange_id": answer_chunk.exchange_id, "text": msg}
                     self.tts_conversion_queue.put(tts_entry)
                     any_code_chunk_yet = True
 
-        if sentence_for_tts and not self.reply_only_as_text:
+        text_for_tts += sentence_for_tts
+        if text_for_tts and not self.reply_only_as_text:
             tts_entry = {
                 "exchange_id": answer_chunk.exchange_id,
-                "text": sentence_for_tts,
+                "text": text_for_tts,
             }
             self.tts_conversion_queue.put(tts_entry)
 
@@ -228,46 +284,50 @@ class VoiceChat(Chat):
 
     def handle_update_audio_history(self, current_answer_audios_queue: queue.Queue):
         """Handle updating the chat history with the replies' audio file paths."""
-        # Merge all AudioSegments in self.current_answer_audios_queue into a single one
-        merged_audios = defaultdict(AudioSegment.empty)
+        # Merge all AudioSegments in self.current_answer_audios_queue into a single one.
+        # Chunks are only concatenated when the reply finishes. Adding them one by one
+        # would copy the whole audio received so far each time.
+        reply_audio_chunks = defaultdict(list)
         while not self.exit_chat.is_set():
+            logger.debug("Waiting for reply audio chunks to concatenate and save...")
+            audio_chunk_queue_item = current_answer_audios_queue.get()
             try:
-                logger.debug("Waiting for reply audio chunks to concatenate and save...")
-                audio_chunk_queue_item = current_answer_audios_queue.get()
                 reply_audio_chunk = audio_chunk_queue_item["speech"]
                 exchange_id = audio_chunk_queue_item["exchange_id"]
                 logger.debug("Received audio chunk for response ID {}", exchange_id)
 
                 if reply_audio_chunk is not None:
                     # Reply not yet finished
-                    merged_audios[exchange_id] += reply_audio_chunk
+                    reply_audio_chunks[exchange_id].append(reply_audio_chunk)
                     logger.debug(
-                        "Response ID {} audio: {}s so far",
+                        "Response ID {} audio: {} chunks so far",
                         exchange_id,
-                        merged_audios[exchange_id].duration_seconds,
+                        len(reply_audio_chunks[exchange_id]),
                     )
-                    current_answer_audios_queue.task_done()
                     continue
 
                 # Now the reply has finished
                 logger.debug(
                     "Creating a single audio file for response ID {}...", exchange_id
                 )
-                merged_audio = merged_audios[exchange_id]
-                # Update the chat history with the audio file path
+                merged_audio = _concatenate_audio_segments(
+                    reply_audio_chunks.pop(exchange_id, [])
+                )
+                # Save the combined audio as an mp3 file in the cache directory
                 fpath = self.audio_cache_dir() / f"{datetime.now().isoformat()}.mp3"
+                merged_audio.export(fpath, format="mp3")
+                logger.debug("File {} stored", fpath)
+                # Update the chat history with the audio file path, now that it exists
                 logger.debug("Updating chat history with audio file path {}", fpath)
                 self.context_handler.database.insert_assistant_audio_file_path(
                     exchange_id=exchange_id, file_path=fpath
                 )
-                # Save the combined audio as an mp3 file in the cache directory
-                merged_audio.export(fpath, format="mp3")
-                logger.debug("File {} stored", fpath)
-                del merged_audios[exchange_id]
-                current_answer_audios_queue.task_done()
             except Exception as error:  # noqa: BLE001
                 logger.error(error)
                 logger.opt(exception=True).debug(error)
+            finally:
+                # Readers wait on this queue for the reply's audio file to be ready
+                current_answer_audios_queue.task_done()
 
     def speak(self, tts: TextToSpeech):
         """Reproduce audio from a pygame Sound object."""
@@ -321,7 +381,7 @@ class VoiceChat(Chat):
             finally:
                 check_for_interrupt_expressions_queue.task_done()
 
-    def listen(self, duration_seconds: float = np.inf) -> AudioSegment:
+    def listen(self, duration_seconds: float = np.inf) -> AudioSegment:  # noqa: PLR0915
         """Record audio from the microphone until user stops."""
         # Adapted from
         # <https://python-sounddevice.readthedocs.io/en/0.4.6/examples.html#
@@ -336,13 +396,17 @@ class VoiceChat(Chat):
             inactivity_timeout_seconds = duration_seconds
 
         q = queue.Queue()
+        # Blocks already processed, to be reused instead of allocating new ones
+        free_blocks = deque()
 
         def callback(indata, frames, time, status):  # noqa: ARG001
             """This is called (from a separate thread) for each audio block."""
-            q.put(indata.copy())
+            block = free_blocks.popleft() if free_blocks else np.empty_like(indata)
+            np.copyto(block, indata)
+            q.put(block)
 
         raw_buffer = io.BytesIO()
-        start_time = datetime.now()
+        start_time = time.monotonic()
         with self.get_sound_file(raw_buffer, mode="x") as sound_file, sd.InputStream(
             samplerate=self.sample_rate,
             blocksize=self.block_size,
@@ -355,37 +419,47 @@ class VoiceChat(Chat):
             voice_activity_detected = deque(
                 maxlen=int((1000.0 * inactivity_timeout_seconds) / self.frame_duration)
             )
-            last_inactivity_checked = datetime.now()
+            n_speech_chunks = 0
+            last_inactivity_checked = time.monotonic()
             continue_recording = True
             speech_detected = False
             elapsed_time = 0.0
+            # Write the recorded blocks to the sound file in batches of ~100 ms
+            blocks_to_write = []
+            max_blocks_to_write = max(1, round(100 / self.frame_duration))
             with contextlib.suppress(KeyboardInterrupt):
                 while continue_recording and elapsed_time < duration_seconds:
                     new_data = q.get()
-                    sound_file.write(new_data)
-
-                    # Gather voice activity samples for the inactivity check
-                    wav_buffer = _np_array_to_wav_in_memory(
-                        sound_data=new_data,
-                        sample_rate=self.sample_rate,
-                        subtype="PCM_16",
-                    )
 
+                    # Gather voice activity samples for the inactivity check.
+                    # The stream gives mono int16 blocks, i.e., already the raw PCM
+                    # data the VAD expects, so no need to encode them as WAV first.
                     vad_thinks_this_chunk_is_speech = self.vad.is_speech(
-                        wav_buffer, self.sample_rate
+                        new_data.tobytes(), self.sample_rate
                     )
+                    # Keep a running count of the speech chunks in the window
+                    if (
+                        voice_activity_detected
+                        and len(voice_activity_detected) == voice_activity_detected.maxlen
+                    ):
+                        n_speech_chunks -= voice_activity_detected[0]
                     voice_activity_detected.append(vad_thinks_this_chunk_is_speech)
+                    n_speech_chunks += vad_thinks_this_chunk_is_speech
+
+                    blocks_to_write.append(new_data)
+                    if len(blocks_to_write) >= max_blocks_to_write:
+                        sound_file.write(np.concatenate(blocks_to_write))
+                        free_blocks.extend(blocks_to_write)
+                        blocks_to_write.clear()
 
                     # Decide if user has been inactive for too long
-                    now = datetime.now()
+                    now = time.monotonic()
                     if duration_seconds < np.inf:
                         continue_recording = True
-                    elif (
-                        now - last_inactivity_checked
-                    ).seconds >= inactivity_timeout_seconds:
+                    elif now - last_inactivity_checked >= inactivity_timeout_seconds:
                         speech_likelihood = 0.0
                         if len(voice_activity_detected) > 0:
-                            speech_likelihood = sum(voice_activity_detected) / len(
+                            speech_likelihood = n_speech_chunks / len(
                                 voice_activity_detected
                             )
                         continue_recording = (
@@ -395,7 +469,10 @@ class VoiceChat(Chat):
                             speech_detected = True
                         last_inactivity_checked = now
 
-                    elapsed_time = (now - start_time).seconds
+                    elapsed_time = now - start_time
+
+            if blocks_to_write:
+                sound_file.write(np.concatenate(blocks_to_write))
 
         if speech_detected or duration_seconds < np.inf:
             return AudioSegment.from_wav(raw_buffer)
@@ -420,11 +497,8 @@ class VoiceChat(Chat):
                 question = self.stt(speech=audio).text
 
                 # Check for the exit expressions
-                if any(
-                    _get_lower_alphanumeric(question).startswith(
-                        _get_lower_alphanumeric(expr)
-                    )
-                    for expr in self.exit_expressions
+                if _get_lower_alphanumeric(question).startswith(
+                    self._normalized_exit_expressions
                 ):
                     questions_queue.put(None)
                 elif question:
@@ -451,22 +525,23 @@ class VoiceChat(Chat):
         """Handle the text-to-speech queue."""
         logger.debug("Chat {}: TTS conversion handler started.", self.id)
         while not self.exit_chat.is_set():
+            tts_entry = tts_conversion_queue.get()
             try:
-                tts_entry = tts_conversion_queue.get()
                 if tts_entry["text"] is None:
-                    # Signal that the current anwer is finished
+                    # Signal that the current anwer is finished. Queue this for the
+                    # audio history first, so that it is already waiting there for
+                    # whoever sees the playing queue done and then joins that one.
                     play_speech_queue_item = {
                         "exchange_id": tts_entry["exchange_id"],
                         "speech": None,
                     }
-                    self.play_speech_queue.put(play_speech_queue_item)
                     self.current_answer_audios_queue.put(play_speech_queue_item)
+                    self.play_speech_queue.put(play_speech_queue_item)
 
                     logger.debug(
                         "Reply ID {} notified that is has finished",
                         tts_entry["exchange_id"],
                     )
-                    tts_conversion_queue.task_done()
                     continue
 
                 text = tts_entry["text"].strip()
@@ -477,9 +552,7 @@ class VoiceChat(Chat):
                         text,
                     )
 
-                    tts_obj = self.tts(text)
-                    # Trigger the TTS conversion
-                    _ = tts_obj.speech
+                    tts_obj = self._tts_with_cache(text)
 
                     logger.debug(
                         "Reply ID {}: Sending speech for '{}' to the playing queue",
@@ -491,15 +564,15 @@ class VoiceChat(Chat):
                         "tts_obj": tts_obj,
                         "speech": tts_obj.speech,
                     }
-                    self.play_speech_queue.put(play_speech_queue_item)
                     self.current_answer_audios_queue.put(play_speech_queue_item)
-
-                # Pay attention to the indentation level
-                tts_conversion_queue.task_done()
+                    self.play_speech_queue.put(play_speech_queue_item)
 
             except Exception as error:  # noqa: BLE001
                 logger.opt(exception=True).debug(error)
                 logger.error(error)
+            finally:
+                # Readers wait on this queue before waiting on the ones it feeds
+                tts_conversion_queue.task_done()
         logger.error("TTS conversion queue handler ended.")
 
     def get_sound_file(self, wav_buffer: io.BytesIO, mode: str = "r"):
@@ -543,12 +616,36 @@ def _check_needed_imports():
         )
 
 
-def _np_array_to_wav_in_memory(
-    sound_data: np.ndarray, sample_rate: int, subtype="PCM_16"
-):
-    """Convert the recorded array to an in-memory wav file."""
-    wav_buffer = io.BytesIO()
-    wav_buffer.name = "audio.wav"
-    sf.write(wav_buffer, sound_data, sample_rate, subtype=subtype)
-    wav_buffer.seek(44)  # Skip the WAV header
-    return wav_buffer.read()
+def _drain_queue(the_queue: queue.Queue):
+    """Remove all items from `the_queue`, marking them as done."""
+    with the_queue.mutex:
+        n_items = len(the_queue.queue)
+        the_queue.queue.clear()
+        # Otherwise, the queue's join() & unfinished_tasks would still count the items
+        the_queue.unfinished_tasks -= n_items
+        if the_queue.unfinished_tasks == 0:
+            the_queue.all_tasks_done.notify_all()
+
+
+def _concatenate_audio_segments(segments: list[AudioSegment]) -> AudioSegment:
+    """Concatenate `segments` with a single copy of their raw data."""
+    if not segments:
+        return AudioSegment.empty()
+
+    first = segments[0]
+    raw_data = bytearray()
+    for segment in segments:
+        # TTS chunks share a format, but make sure they match the first one anyway
+        segment = (  # noqa: PLW2901
+            segment.set_channels(first.channels)
+            .set_frame_rate(first.frame_rate)
+            .set_sample_width(first.sample_width)
+        )
+        raw_data.extend(segment.raw_data)
+
+    return AudioSegment(
+        data=bytes(raw_data),
+        sample_width=first.sample_width,
+        frame_rate=first.frame_rate,
+        channels=first.channels,
+    )
@@ -4,6 +4,7 @@ import streamlit
 import streamlit_webrtc.component
 
 from pyrobbot.app import app
+from pyrobbot.app.app_page_templates import AppPage, ChatBotPage
 
 
 def test_app(mocker, default_voice_chat_configs):
@@ -41,3 +42,14 @@ def test_app(mocker, default_voice_chat_configs):
     )
 
     app.run_app()
+
+
+def test_chat_bot_page_can_be_instantiated(mocker, default_voice_chat_configs):
+    parent = mocker.MagicMock()
+    parent.state = {"chat_configs": default_voice_chat_configs}
+    chat_obj = mocker.MagicMock(configs=default_voice_chat_configs)
+
+    page = ChatBotPage(parent=parent, chat_obj=chat_obj)
+
+    assert page.chat_obj is chat_obj
+    assert "render" in AppPage.__abstractmethods__
@@ -0,0 +1,164 @@
+import sqlite3
+import sys
+import threading
+
+import pandas as pd
+import pytest
+
+from pyrobbot.tokens import PRICE_PER_K_TOKENS_LLM, TokenUsageDatabase
+
+
+@pytest.fixture()
+def token_usage_db(tmp_path):
+    return TokenUsageDatabase(fpath=tmp_path / "token_usage.db")
+
+
+def test_inserted_data_is_buffered_until_flush(token_usage_db):
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    n_input_tokens, n_output_tokens = 10, 5
+    token_usage_db.insert_data(
+        model=model, n_input_tokens=n_input_tokens, n_output_tokens=n_output_tokens
+    )
+    assert len(token_usage_db._pending) == 1
+
+    token_usage_db.flush()
+    assert not token_usage_db._pending
+
+    usage_df = token_usage_db.get_usage_balance_dataframe()
+    assert usage_df[("Tokens", "In")].iloc[0] == n_input_tokens
+    assert usage_df[("Tokens", "Out")].iloc[0] == n_output_tokens
+
+
+def test_buffer_is_flushed_when_full(tmp_path):
+    db = TokenUsageDatabase(fpath=tmp_path / "token_usage.db", max_pending_rows=2)
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    db.insert_data(model=model, n_input_tokens=1)
+    db.insert_data(model=model, n_input_tokens=1)
+    assert not db._pending
+
+
+def test_concurrent_inserts_are_all_written_once(tmp_path):
+    db = TokenUsageDatabase(fpath=tmp_path / "token_usage.db", max_pending_rows=3)
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    n_threads, n_inserts_per_thread = 8, 100
+
+    def insert_rows():
+        for _ in range(n_inserts_per_thread):
+            db.insert_data(model=model, n_input_tokens=1)
+
+    # Switch threads often, to make interleaved inserts and flushes likely
+    original_switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=insert_rows) for _ in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(original_switch_interval)
+
+    usage_df = db.get_usage_balance_dataframe()
+    assert usage_df[("Tokens", "In")].loc["Total"] == n_threads * n_inserts_per_thread
+
+
+def test_usage_dataframe_includes_pending_data(token_usage_db):
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    n_input_tokens = 1000
+    token_usage_db.insert_data(model=model, n_input_tokens=n_input_tokens)
+    usage_df = token_usage_db.get_usage_balance_dataframe()
+    assert usage_df[("Tokens", "Tot.")].loc["Total"] == n_input_tokens
+
+
+def test_usage_dataframe_has_no_totals_row_when_empty(token_usage_db):
+    usage_df = token_usage_db.get_usage_balance_dataframe()
+    assert usage_df.empty
+    assert ("Tokens", "Tot.") in usage_df.columns
+
+
+def test_data_version_changes_with_new_data(tmp_path):
+    fpath = tmp_path / "token_usage.db"
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    db = TokenUsageDatabase(fpath=fpath)
+    other_db = TokenUsageDatabase(fpath=fpath)
+
+    version = db.data_version
+    assert db.data_version == version
+
+    db.insert_data(model=model, n_input_tokens=1)
+    assert db.data_version != version
+
+    version = db.data_version
+    other_db.insert_data(model=model, n_input_tokens=1)
+    other_db.flush()
+    assert db.data_version != version
+
+
+def test_data_version_is_the_same_for_all_instances(tmp_path):
+    fpath = tmp_path / "token_usage.db"
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    db = TokenUsageDatabase(fpath=fpath)
+    other_db = TokenUsageDatabase(fpath=fpath)
+
+    db.insert_data(model=model, n_input_tokens=100)
+    other_db.insert_data(model=model, n_input_tokens=20)
+    other_db.insert_data(model=model, n_input_tokens=100)
+    for instance in (db, other_db):
+        instance.flush()
+    assert db.data_version == other_db.data_version
+
+
+def test_totals_are_backfilled_for_existing_databases(tmp_path):
+    fpath = tmp_path / "token_usage.db"
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    n_input_tokens = 7
+    conn = sqlite3.connect(fpath)
+    with conn:
+        conn.execute(
+            "CREATE TABLE token_costs (timestamp INTEGER NOT NULL, model TEXT NOT NULL, "
+            "n_input_tokens INTEGER NOT NULL, n_output_tokens INTEGER NOT NULL, "
+            "cost_input_tokens REAL NOT NULL, cost_output_tokens REAL NOT NULL)"
+        )
+        conn.execute(
+            "INSERT INTO token_costs VALUES (0, ?, ?, 0, 0.0, 0.0)",
+            (model, n_input_tokens),
+        )
+    conn.close()
+
+    for _ in range(2):  # Make sure reopening the db doesn't count the data twice
+        db = TokenUsageDatabase(fpath=fpath)
+        usage_df = db.get_usage_balance_dataframe()
+        assert usage_df[("Tokens", "In")].loc["Total"] == n_input_tokens
+        db.close()
+
+
+def test_totals_row_keeps_the_column_types(token_usage_db):
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    n_input_tokens, n_output_tokens = 3, 2
+    token_usage_db.insert_data(
+        model=model, n_input_tokens=n_input_tokens, n_output_tokens=n_output_tokens
+    )
+    usage_df = token_usage_db.get_usage_balance_dataframe()
+    for column in ["In", "Out", "Tot."]:
+        assert pd.api.types.is_integer_dtype(usage_df[("Tokens", column)])
+        assert pd.api.types.is_float_dtype(usage_df[("Cost ($)", column)])
+    assert usage_df[("Tokens", "Tot.")].loc["Total"] == n_input_tokens + n_output_tokens
+
+
+def test_insert_many_matches_insert_data(tmp_path):
+    model = next(iter(PRICE_PER_K_TOKENS_LLM))
+    rows = [(model, 10, 5), (model, 3, 0, 1000), (None, 1, 1)]
+
+    bulk_db = TokenUsageDatabase(fpath=tmp_path / "bulk.db")
+    bulk_db.insert_many(rows)
+    assert not bulk_db._pending
+
+    single_db = TokenUsageDatabase(fpath=tmp_path / "single.db")
+    for row_model, n_input_tokens, n_output_tokens, *timestamp in rows:
+        single_db.insert_data(row_model, n_input_tokens, n_output_tokens, *timestamp)
+
+    bulk_totals, single_totals = (
+        db.get_usage_balance_dataframe().loc["Total", ["Tokens", "Cost ($)"]]
+        for db in (bulk_db, single_db)
+    )
+    assert bulk_totals.to_list() == pytest.approx(single_totals.to_list())
@@ -1,4 +1,5 @@
 import contextlib
+import queue
 
 import pytest
 from pydantic import ValidationError
@@ -7,7 +8,7 @@ from sounddevice import PortAudioError
 
 from pyrobbot.chat_configs import VoiceChatConfigs
 from pyrobbot.sst_and_tts import TextToSpeech
-from pyrobbot.voice_chat import VoiceChat
+from pyrobbot.voice_chat import VoiceChat, _drain_queue
 
 
 def test_soundcard_import_check(mocker, caplog):
@@ -69,3 +70,17 @@ def test_handle_interrupt_expressions(default_voice_chat, mocker):
     }
     default_voice_chat.check_for_interrupt_expressions_queue.put(msgs_to_compare)
     default_voice_chat.start()
+
+
+def test_drained_queue_has_no_unfinished_tasks():
+    the_queue = queue.Queue()
+    for item in range(3):
+        the_queue.put(item)
+    the_queue.get()
+
+    _drain_queue(the_queue)
+    assert the_queue.empty()
+    assert the_queue.unfinished_tasks == 1
+
+    the_queue.task_done()
+    the_queue.join()